@@ -25,47 +25,147 @@ finding data files to download.
 # License: Open Source MIT
 # Copyright (c) Joe Linoff
 import argparse
+import email.utils
+import errno
 import getpass
 import inspect
+import json
+import mimetypes
 import os
 import re
 import socket
 import ssl
 import string
 import sys
+import threading
+import time
+from collections import OrderedDict
 
 try:
     from html.parser import HTMLParser
     import urllib.request as UrlRequest  # UrlRequest.urlopen()
     import urllib.error as UrlError
+    from urllib.parse import urlparse
+    import queue as Queue
+    import http.client as HttpClient
+    from http.cookiejar import CookieJar
 except ImportError:
     from HTMLParser import HTMLParser
     import urllib2 as UrlRequest  # UrlRequest.urlopen()
     import urllib2 as UrlError
+    from urlparse import urlparse
+    import Queue
+    import httplib as HttpClient
+    from cookielib import CookieJar
     ConnectionError = OSError  # only in python3
 
 
 #VERSION = '0.1.0'  # Initial release.
 #VERSION = '0.2.0'  # Don't replicate files that already exist, added -c, --debug.
-VERSION = '0.3.0'  # Fixed clean_url() to avoid infinite loop, report HTMLs as dirs
+#VERSION = '0.3.0'  # Fixed clean_url() to avoid infinite loop, report HTMLs as dirs
+#VERSION = '0.4.0'  # Fast path for autoindex directory listings.
+#VERSION = '0.5.0'  # Added the external link cache: --cache, --cache-ttl, --cache-size.
+#VERSION = '0.6.0'  # Asynchronous writes for -r and -c: --writers, --write-buffer, --fsync.
+#VERSION = '0.7.0'  # Keep the data as bytes, only decode it for the link extraction.
+#VERSION = '0.8.0'  # Adaptive per host request rate, added --stats.
+VERSION = '0.9.0'  # Reuse the opener and the SSL context, resume TLS sessions.
+
+# Apache and nginx autoindex pages.
+AUTOINDEX_TITLE = re.compile(r'<title>\s*Index of ', re.IGNORECASE)
+AUTOINDEX_HEADING = re.compile(r'<h1>\s*Index of [^<]*</h1>\s*(?:<hr>\s*)?<(?:pre|table)\b', re.IGNORECASE)
+AUTOINDEX_ENTRY = re.compile(r'<a\s+href="([^"]*)"[^>]*>', re.IGNORECASE)
+AUTOINDEX_STAT = re.compile(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}(?::\d{2})?|'
+                            r'\d{2}-\w{3}-\d{4} \d{2}:\d{2}(?::\d{2})?)\s+(\S+)')
+AUTOINDEX_TAG = re.compile(r'<[^>]*>')
+
+# Failures that may go away, like timeouts, 5xx and 429, are only
+# cached for this many seconds and they are not saved.
+TRANSIENT_TTL = 300
+
+# AIMD request window per host.
+# A window of 1 is full speed, a window of 0.5 waits one request
+# latency between requests and so on.
+LIMIT_MIN = 0.05
+LIMIT_INCREASE = 0.1  # additive, on success
+LIMIT_DECREASE = 0.5  # multiplicative, on server errors or a sustained latency rise
+LATENCY_RECENT = 0.2  # EWMA weight of the recent latency
+LATENCY_BASELINE = 0.02  # EWMA weight of the baseline latency
+LATENCY_FACTOR = 4  # slow is this many times the baseline latency
+LATENCY_FLOOR = 0.25  # and at least this many seconds
+LATENCY_SUSTAINED = 3  # a rise is this many slow responses in a row
+DELAY_FLOOR = 0.1  # the smallest latency used for the delay, in seconds
+RETRY_AFTER_MAX = 300  # longest Retry-After honored, in seconds
+
+# <meta charset="x"> and <meta http-equiv="Content-Type" content="text/html; charset=x">
+META_CHARSET = re.compile(br'<meta[^>]+charset=["\']?([\w.:-]+)', re.IGNORECASE)
+
 
 class MyHtmlParser(HTMLParser):
     '''
     Grab all of the file references from a page.
 
     The user must call analyze() to parse the html data instead of feed().
+
+    Autoindex directory listings are not fed to the HTMLParser, they
+    are scanned line by line and the size and modification time of
+    each entry is recorded in m_entries.
     '''
     def analyze(self, url, html):
         '''
         Analyze the HTML.
         '''
         self.__setup(url)
+        if is_autoindex(html):
+            self.__analyze_autoindex(html)
+            if self.m_entries:
+                return
+            setattr(self, 'm_list', [])  # not a listing after all
         self.feed(html)
 
     def __setup(self, url):
         setattr(self, 'm_list', [])
         setattr(self, 'm_url', self.__clean_url(url))
         setattr(self, 'm_base', None)
+        setattr(self, 'm_entries', {})
+
+    def __analyze_autoindex(self, html):
+        '''
+        Extract the entries from an autoindex listing.
+
+        Only the anchors are of interest, everything after the anchor
+        on the same line is the modification time and the size.
+        The entries are added to m_list directly, handle_starttag() is
+        too slow for listings with thousands of entries.
+        '''
+        seen = set()
+        for match in AUTOINDEX_ENTRY.finditer(html):
+            href = match.group(1)
+            if href.startswith('/') or href.startswith('../'):
+                continue  # parent links are outside of the tree
+            if href.startswith('?') or href.startswith('#'):
+                continue  # sort order links are not entries
+            path = self.__create_url(href)
+            if path is None or path == self.m_url or path in seen:
+                continue
+            seen.add(path)
+            self.m_list.append(path)
+            end = html.find('\n', match.end())
+            line = html[match.end():end if end >= 0 else len(html)]
+            lower = line.lower()
+            start = lower.find('</a>')  # skip the name
+            start = start + 4 if start >= 0 else len(line)
+            stop = lower.find('<a ', start)  # and the next anchor
+            tail = line[start:stop if stop >= 0 else len(line)]
+            tail = AUTOINDEX_TAG.sub(' ', tail).replace('&nbsp;', ' ')
+            stat = AUTOINDEX_STAT.search(tail)
+            mtime = stat.group(1) if stat else None
+            size = stat.group(2) if stat else '-'
+            self.m_entries[path] = {
+                'isdir': href.endswith('/'),
+                'mtime': mtime,
+                'size': size,
+                'bytes': int(size) if size.isdigit() else None,  # exact sizes only
+            }
 
     @staticmethod
     def __clean_url(url):
@@ -144,6 +244,401 @@ class MyHtmlParser(HTMLParser):
         pass
 
 
+class LinkCache(object):
+    '''
+    Cache the results of the external link checks.
+
+    The entries are kept in least recently used order so that the
+    oldest ones are evicted when the cache is full. If a path is
+    specified, the entries that have not expired are loaded at startup
+    and saved at exit so that they are shared across runs.
+    '''
+    def __init__(self, path=None, ttl=86400, size=10000):
+        self.m_path = path
+        self.m_ttl = ttl
+        self.m_size = size
+        self.m_entries = OrderedDict()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        '''
+        Load the unexpired entries from the cache file.
+        '''
+        now = time.time()
+        entries = []
+        with open(self.m_path, 'r') as ifp:
+            try:
+                for url, entry in json.load(ifp):
+                    for key in ('status', 'error', 'size', 'type', 'checked'):
+                        if key not in entry:
+                            return  # corrupt, start over
+                    entry['checked'] = float(entry['checked'])
+                    if now - entry['checked'] < self.m_ttl:
+                        entries.append((url, entry))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                return  # corrupt, start over
+        for url, entry in entries:
+            self.put(url, entry)
+
+    def save(self):
+        '''
+        Save the entries to the cache file, oldest first.
+        Transient failures are not saved.
+        '''
+        if self.m_path is None:
+            return
+        entries = [(url, entry) for url, entry in self.m_entries.items()
+                   if entry.get('transient', False) is False]
+        tmp = self.m_path + '.tmp'
+        replace = getattr(os, 'replace', os.rename)  # rename fails on windows if it exists
+        try:
+            with open(tmp, 'w') as ofp:
+                json.dump(entries, ofp)
+            replace(tmp, self.m_path)
+        except (IOError, OSError) as exc:
+            sys.stderr.write('WARNING: {}: {}\n'.format(str(exc), self.m_path))
+
+    def get(self, url):
+        '''
+        Get the entry for the url if it has not expired.
+        '''
+        entry = self.m_entries.pop(url, None)
+        if entry is None:
+            return None
+        ttl = self.m_ttl
+        if entry.get('transient', False):
+            ttl = min(ttl, TRANSIENT_TTL)
+        if time.time() - entry['checked'] >= ttl:
+            return None
+        self.m_entries[url] = entry  # most recently used
+        return entry
+
+    def put(self, url, entry):
+        '''
+        Add the entry for the url, evict the oldest if the cache is full.
+        '''
+        self.m_entries.pop(url, None)
+        self.m_entries[url] = entry
+        while len(self.m_entries) > self.m_size:
+            self.m_entries.popitem(last=False)
+
+
+class FileWriter(object):
+    '''
+    Write the replicated and copied files in background threads so
+    that the walk does not wait for the disk.
+
+    The amount of data waiting to be written is limited, the walk
+    blocks when the limit is reached. Directories that are known to
+    exist are cached so that they are not checked again.
+
+    Files that already exist are not overwritten.
+    '''
+    def __init__(self, threads=4, limit=64*1024*1024, fsync=0, no_warnings=False):
+        self.m_queue = Queue.Queue()
+        self.m_cond = threading.Condition()
+        self.m_queued = 0  # bytes waiting to be written
+        self.m_limit = limit
+        self.m_fsync = fsync
+        self.m_no_warnings = no_warnings
+        self.m_dirs = set()
+        self.m_claimed = set()
+        self.m_threads = []
+        for _ in range(max(threads, 1)):
+            thread = threading.Thread(target=self.__run)
+            thread.daemon = True
+            thread.start()
+            self.m_threads.append(thread)
+
+    def write(self, path, data):
+        '''
+        Queue the data to be written to path.
+        '''
+        if path in self.m_claimed:
+            return  # already queued
+        self.m_claimed.add(path)
+        size = len(data)
+        with self.m_cond:
+            while self.m_queued > 0 and self.m_queued + size > self.m_limit:
+                self.m_cond.wait()
+            self.m_queued += size
+        self.m_queue.put((path, data))
+
+    def close(self):
+        '''
+        Wait for the queued data to be written.
+        '''
+        for _ in self.m_threads:
+            self.m_queue.put(None)
+        for thread in self.m_threads:
+            thread.join()
+
+    def __makedirs(self, dirpath):
+        if dirpath in self.m_dirs:
+            return
+        try:
+            os.makedirs(dirpath)
+        except OSError:
+            if os.path.isdir(dirpath) is False:
+                raise
+        while dirpath not in self.m_dirs and dirpath != os.path.dirname(dirpath):
+            self.m_dirs.add(dirpath)
+            dirpath = os.path.dirname(dirpath)
+
+    def __sync(self, paths):
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except (IOError, OSError) as exc:
+                if self.m_no_warnings is False:
+                    sys.stderr.write('WARNING: {}: {}\n'.format(str(exc), path))
+
+    def __store(self, path, data):
+        '''
+        Write the file if it does not exist.
+        Return True if it was written.
+        '''
+        self.__makedirs(os.path.dirname(path))
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+        try:
+            fd = os.open(path, flags, 0o666)
+        except OSError as exc:
+            if exc.errno == errno.EEXIST:
+                return False
+            raise
+        with os.fdopen(fd, 'wb') as ofp:
+            ofp.write(data)
+        return True
+
+    def __run(self):
+        pending = []  # written but not synced
+        while True:
+            item = self.m_queue.get()
+            if item is None:
+                break
+            path, data = item
+            try:
+                if self.__store(path, data) and self.m_fsync > 0:
+                    pending.append(path)
+                    if len(pending) >= self.m_fsync:
+                        self.__sync(pending)
+                        pending = []
+            except (IOError, OSError) as exc:
+                if self.m_no_warnings is False:
+                    sys.stderr.write('WARNING: {}: {}\n'.format(str(exc), path))
+            finally:
+                with self.m_cond:
+                    self.m_queued -= len(data)
+                    self.m_cond.notify_all()
+        self.__sync(pending)
+
+
+class HostLimiter(object):
+    '''
+    Adapt the request rate to each host using AIMD.
+
+    The window grows additively while the host answers normally and it
+    is halved when the host returns server errors (5xx, 429), fails to
+    connect or when the recent latency rises well above the baseline.
+    The walk only has one request in flight so a window below 1 is
+    applied as a delay between requests. The delay is based on the
+    latency of the normal responses because failures are often fast.
+    A Retry-After header on a 429 or 503 is honored.
+
+    The window is only adapted if enabled, otherwise the statistics are
+    collected and the walk runs at full speed.
+    '''
+    def __init__(self, enabled=False):
+        self.m_enabled = enabled
+        self.m_hosts = {}
+
+    def __host(self, url):
+        host = urlparse(url).netloc
+        if host not in self.m_hosts:
+            self.m_hosts[host] = {'limit': 1.0, 'latency': None, 'baseline': None,
+                                  'slow': 0, 'requests': 0, 'errors': 0, 'last': 0.0,
+                                  'until': 0.0}
+        return self.m_hosts[host]
+
+    def wait(self, url):
+        '''
+        Wait until the next request to the host is allowed.
+        '''
+        state = self.__host(url)
+        resume = state['until']
+        if state['limit'] < 1.0:
+            latency = max(state['baseline'] or 0.0, DELAY_FLOOR)
+            resume = max(resume, state['last'] + latency * (1.0 / state['limit'] - 1.0))
+        remaining = resume - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def update(self, url, latency, okay, retry_after=None):
+        '''
+        Update the window of the host from the result of a request.
+
+        Only the normal responses update the latency.
+        '''
+        state = self.__host(url)
+        state['requests'] += 1
+        state['last'] = time.time()
+        if okay is False:
+            state['errors'] += 1
+            if self.m_enabled:
+                state['limit'] = max(state['limit'] * LIMIT_DECREASE, LIMIT_MIN)
+                if retry_after is not None:
+                    state['until'] = state['last'] + min(retry_after, RETRY_AFTER_MAX)
+            return
+        if state['latency'] is None:
+            state['latency'] = latency
+            state['baseline'] = latency
+        if latency > max(LATENCY_FACTOR * state['baseline'], LATENCY_FLOOR):
+            state['slow'] += 1
+        else:
+            state['slow'] = 0
+        rise = state['slow'] >= LATENCY_SUSTAINED
+        if rise:
+            state['slow'] = 0  # one decrease per rise
+        state['latency'] += LATENCY_RECENT * (latency - state['latency'])
+        state['baseline'] += LATENCY_BASELINE * (latency - state['baseline'])
+        if self.m_enabled is False:
+            return
+        if rise:
+            state['limit'] = max(state['limit'] * LIMIT_DECREASE, LIMIT_MIN)
+        else:
+            state['limit'] = min(state['limit'] + LIMIT_INCREASE, 1.0)
+
+    def stats(self):
+        '''
+        Report the current state of each host.
+        '''
+        for host in sorted(self.m_hosts):
+            state = self.m_hosts[host]
+            sys.stderr.write('STATS: {}  limit {:.2f}  requests {}  errors {}  latency {:.3f}s\n'.format(
+                host, state['limit'], state['requests'], state['errors'], state['latency'] or 0.0))
+
+
+class ResumingSSLSocket(ssl.SSLSocket):
+    '''
+    Save the TLS session when the socket is closed so that the next
+    connection to the same host can resume it.
+
+    The session is saved at close time because TLS 1.3 tickets arrive
+    after the handshake.
+    '''
+    def close(self):
+        sessions = getattr(self, 'm_sessions', None)
+        if sessions is not None and self.session is not None:
+            sessions[self.server_hostname] = self.session
+        ssl.SSLSocket.close(self)
+
+
+class ResumingHTTPSConnection(HttpClient.HTTPSConnection):
+    '''
+    HTTPS connection that resumes the saved TLS session for the host.
+    '''
+    m_sessions = None
+
+    def connect(self):
+        HttpClient.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host if self._tunnel_host else self.host
+        self.sock = self._context.wrap_socket(self.sock,
+                                              server_hostname=server_hostname,
+                                              session=self.m_sessions.get(server_hostname))
+        self.sock.m_sessions = self.m_sessions
+
+
+class ResumingHTTPSHandler(UrlRequest.HTTPSHandler):
+    '''
+    HTTPS handler that shares the TLS sessions across connections.
+    '''
+    def __init__(self, context):
+        UrlRequest.HTTPSHandler.__init__(self, context=context)
+        context.sslsocket_class = ResumingSSLSocket
+        self.m_context = context
+        self.m_sessions = {}
+
+    def https_open(self, req):
+        sessions = self.m_sessions
+        def connection(host, **kwargs):
+            'create the connection with the shared sessions'
+            conn = ResumingHTTPSConnection(host, **kwargs)
+            conn.m_sessions = sessions
+            return conn
+        return self.do_open(connection, req, context=self.m_context)
+
+
+class Session(object):
+    '''
+    The HTTP state that is shared by all of the requests: the opener,
+    the SSL context, the TLS sessions, the cookies and the credentials.
+
+    It is created once so that the setup is not repeated for each URL.
+    The credentials are sent up front to the site that is walked so
+    that each URL does not need a 401 challenge first, other sites get
+    them only when they ask.
+    '''
+    def __init__(self, opts):
+        self.m_authenticate = opts.authenticate
+        self.m_sites = set()
+        self.m_site = self.__site(opts.URL)
+        context = ssl.create_default_context()
+        if opts.authenticate:
+            # CITATION: http://stackoverflow.com/questions/19268548/python-ignore-certicate-validation-urllib2
+            # Disable verification - to workaround invalid internal certificates.
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if hasattr(ssl, 'SSLSession') and hasattr(context, 'sslsocket_class'):
+            https = ResumingHTTPSHandler(context)
+        else:
+            https = UrlRequest.HTTPSHandler(context=context)  # no session resumption
+        if hasattr(UrlRequest, 'HTTPPasswordMgrWithPriorAuth'):
+            self.m_pman = UrlRequest.HTTPPasswordMgrWithPriorAuth()
+        else:
+            self.m_pman = UrlRequest.HTTPPasswordMgrWithDefaultRealm()  # python2
+        self.m_opener = UrlRequest.build_opener(https,
+                                                UrlRequest.HTTPBasicAuthHandler(self.m_pman),
+                                                UrlRequest.HTTPCookieProcessor(CookieJar()))
+
+    def open(self, url):
+        '''
+        Open the URL.
+        The credentials are registered for each new site.
+        '''
+        if self.m_authenticate:
+            site = self.__site(url)
+            if site not in self.m_sites:
+                self.m_sites.add(site)
+                username, password = self.m_authenticate
+                if isinstance(self.m_pman, getattr(UrlRequest, 'HTTPPasswordMgrWithPriorAuth', ())):
+                    self.m_pman.add_password(None, site, username, password,
+                                             is_authenticated=site == self.m_site)
+                else:
+                    self.m_pman.add_password(None, site, username, password)
+        return self.m_opener.open(url)
+
+    @staticmethod
+    def __site(url):
+        parts = urlparse(url)
+        return '{}://{}'.format(parts.scheme, parts.netloc)
+
+
+def is_autoindex(html):
+    '''
+    Is this page an autoindex directory listing?
+
+    Only the beginning of the page is checked. Both the title and the
+    heading that is followed by the pre or table listing must be there.
+    '''
+    head = html[:2048]
+    return AUTOINDEX_TITLE.search(head) is not None and AUTOINDEX_HEADING.search(head) is not None
+
+
 def debug(opts, msg):
     '''
     Display a debug message.
@@ -209,49 +704,67 @@ def proceed(url, opts, dups, depth):
     return True  # proceed
 
 
-def openurl(url, opts):
+def retry_after(exc):
     '''
-    Open the current URL.
-
-    Handle authentication, capture exceptions.
+    Get the Retry-After delay in seconds from an HTTPError.
+    It can be a number of seconds or a date.
     '''
-    try:
-        if opts.authenticate:
-            username = opts.authenticate[0]
-            password = opts.authenticate[1]
-            pman = UrlRequest.HTTPPasswordMgrWithDefaultRealm()
-            pman.add_password(None, url, username, password)
+    headers = exc.info()
+    value = headers.get('Retry-After') if headers is not None else None
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(email.utils.mktime_tz(date) - time.time(), 0)
 
-            auth = UrlRequest.HTTPBasicAuthHandler(pman)
-            opener = UrlRequest.build_opener(auth)
-            UrlRequest.install_opener(opener)
 
-            # CITATION: http://stackoverflow.com/questions/19268548/python-ignore-certicate-validation-urllib2
-            # Disable verification - to workaround invalid internal certificates.
-            context = ssl.create_default_context()
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
+def openurl(url, opts, errors=None):
+    '''
+    Open the current URL.
 
-            response = UrlRequest.urlopen(url, context=context)
-        else:
-            response = UrlRequest.urlopen(url)
+    Use the shared session, capture exceptions.
+    If errors is specified, the exception is stored in it.
+    The result is used to adapt the request rate for the host.
+    '''
+    opts.limiter.wait(url)
+    start = time.time()
+    try:
+        response = opts.session.open(url)
+        opts.limiter.update(url, time.time() - start, True)
         return response
 
     except UrlError.HTTPError as exc:
         if opts.no_warnings is False:
             sys.stderr.write('WARNING: {}: {}\n'.format(str(exc), url))
+        if errors is not None:
+            errors[url] = exc
+        opts.limiter.update(url, time.time() - start, exc.code < 500 and exc.code != 429,
+                            retry_after(exc))
 
     except UrlError.URLError as exc:
         if opts.no_warnings is False:
             sys.stderr.write('WARNING: {}: {}\n'.format(str(exc), url))
+        if errors is not None:
+            errors[url] = exc
+        opts.limiter.update(url, time.time() - start, False)
 
     except ConnectionError as exc:
         if opts.no_warnings is False:
             sys.stderr.write('WARNING: {}: {}\n'.format(str(exc), url))
+        if errors is not None:
+            errors[url] = exc
+        opts.limiter.update(url, time.time() - start, False)
 
     except socket.timeout as exc:
         if opts.no_warnings is False:
             sys.stderr.write('WARNING: {}: {}\n'.format(str(exc), url))
+        if errors is not None:
+            errors[url] = exc
+        opts.limiter.update(url, time.time() - start, False)
 
     return None
 
@@ -259,16 +772,32 @@ def openurl(url, opts):
 def read_url_data(response):
     '''
     Read the URL data.
+
+    The raw bytes are returned so that copies are identical to what
+    the server sent. Use decode_url_data() to get the text.
+    '''
+    return response.read()
+
+
+def decode_url_data(response, data):
+    '''
+    Decode the URL data for the link extraction.
+
+    Use the charset from the header, then the meta charset from the
+    page and finally utf-8.
     '''
     try:
         charset = response.headers.get_content_charset()
     except AttributeError:
         charset = response.headers.getparam('charset')
-    if charset is not None:
-        data = response.read().decode(charset)  # use the charset to decode
-    else:
-        data = response.read()  # just read the raw bytes
-    return data
+    if charset is None:
+        match = META_CHARSET.search(data[:1024])
+        if match:
+            charset = match.group(1).decode('ascii')
+    try:
+        return data.decode(charset or 'utf-8', 'replace')
+    except LookupError:
+        return data.decode('utf-8', 'replace')  # unknown charset
 
 
 def display(url, opts):
@@ -353,7 +882,8 @@ def report(url, opts, response, info, reppath, cppath, depth, parent):
 
     if opts.verbose >= 3:  # header
         print('    ' + '\n    '.join(str(info).split('\n')))
-        data = response.read().decode('utf-8', errors='ignore')
+        if data is None:
+            data = read_url_data(response)
 
     return data
 
@@ -395,21 +925,64 @@ def create_cppath(url, opts):
 def copy_to_file(url, opts, response, data, outfile):
     '''
     Copy the outfile locally.
+    The write is done in the background by opts.writer.
     '''
     if data is None:
         data = read_url_data(response)
-    if os.path.exists(outfile) is False:
-        dirpath = os.path.dirname(outfile)
-        if os.path.exists(dirpath) is False:
-            os.makedirs(dirpath)
-        with open(outfile, 'wb') as ofp:
-            try:
-                ofp.write(data)
-            except TypeError:
-                ofp.write(data.encode('utf-8'))
+    opts.writer.write(outfile, data)
     return data
 
 
+def listed(url, opts, entry):
+    '''
+    Can the autoindex listing entry stand in for the response?
+
+    That is true for files that are not HTML when the listing has all
+    of the data that needs to be reported and the local copy, if any,
+    already exists.
+    '''
+    if entry is None or entry['isdir']:
+        return False
+    ctype = mimetypes.guess_type(url)[0]
+    if ctype is None or ctype.find('html') >= 0:
+        return False  # might need to recurse
+    if opts.verbose > 1:
+        return False  # the listing does not have the content-type
+    if opts.verbose > 0 and entry['bytes'] is None:
+        return False  # rounded or missing size
+    if display(url, opts):
+        outfile = create_reppath(url, opts) or create_cppath(url, opts)
+        if outfile is not None and os.path.exists(outfile) is False:
+            return False  # existing files are never overwritten
+    return True
+
+
+def is_external(url, opts):
+    '''
+    Is this URL on a different site than the one being walked?
+    '''
+    return urlparse(url).netloc != urlparse(opts.URL).netloc
+
+
+def cached(url, opts, entry):
+    '''
+    Can the cached check result stand in for the response?
+
+    The cache cannot be used when the data is needed.
+    '''
+    if entry is None:
+        return False
+    if entry['status'] is None:
+        return True  # failures only need the warning
+    if opts.verbose > 2:
+        return False  # the header is not cached
+    if opts.verbose > 0 and entry['size'] is None:
+        return False
+    if display(url, opts) and (opts.replicate or opts.copy):
+        return False
+    return True
+
+
 def is_html(info):
     '''
     Is this page an HTML page?
@@ -433,9 +1006,43 @@ def walk(url, opts, dups, depth=0, recurse=True, parent=None):
         debug(opts, 'ignoring url {}'.format(url))
         return
 
-    response = openurl(url, opts)
+    entry = opts.listing.pop(url, None)
+    if listed(url, opts, entry):
+        debug(opts, 'using listing for url {}: {} {}'.format(url, entry['size'], entry['mtime']))
+        if display(url, opts):
+            info = {'Content-Length': entry['size']}
+            reppath = create_reppath(url, opts)
+            cppath = create_cppath(url, opts)
+            report(url, opts, None, info, reppath, cppath, depth, parent)
+        return
+
+    external = recurse is False and is_external(url, opts)
+    if external:
+        entry = opts.cache.get(url)
+        if cached(url, opts, entry):
+            debug(opts, 'using cached check for url {}'.format(url))
+            if entry['status'] is None:
+                if opts.no_warnings is False:
+                    sys.stderr.write('WARNING: {}: {}\n'.format(entry['error'], url))
+            elif display(url, opts):
+                info = {}
+                if entry['type'] is not None:
+                    info['Content-Type'] = entry['type']
+                if entry['size'] is not None:
+                    info['Content-Length'] = entry['size']
+                report(url, opts, None, info, None, None, depth, parent)
+            return
+
+    errors = {}
+    response = openurl(url, opts, errors)
     if response is None:
         debug(opts, 'no response for url {}'.format(url))
+        if external and url in errors:
+            exc = errors[url]
+            definite = isinstance(exc, UrlError.HTTPError) and \
+                400 <= exc.code < 500 and exc.code not in (408, 429)  # like 404 and 410
+            opts.cache.put(url, {'status': None, 'error': str(exc), 'transient': not definite,
+                                 'size': None, 'type': None, 'checked': time.time()})
         return
 
     info = response.info()
@@ -460,11 +1067,22 @@ def walk(url, opts, dups, depth=0, recurse=True, parent=None):
     else:
         debug(opts, 'not displaying url {}'.format(url))
 
+    if external:
+        size = info['Content-Length'] if 'Content-Length' in info else None
+        if size is None and data is not None:
+            size = len(data)
+        opts.cache.put(url, {'status': response.getcode(), 'error': None,
+                             'size': size, 'type': info['Content-Type'] if 'Content-Type' in info else None,
+                             'checked': time.time()})
+
     if is_html(info) and recurse is True:
         debug(opts, 'recursing on url {}'.format(url))
-        html = read_url_data(response) if data is None else data
+        if data is None:
+            data = read_url_data(response)
+        html = decode_url_data(response, data)
         parser = MyHtmlParser()
         parser.analyze(url, html)  # populate m_list
+        opts.listing.update(parser.m_entries)
         for newurl in parser.m_list:
             recurse = newurl.startswith(url)  # skip external URLs
             walk(newurl, opts, dups, depth+1, recurse=recurse, parent=url)
@@ -573,6 +1191,44 @@ examples:
                                      usage=usage(),
                                      epilog=epilog())
 
+    parser.add_argument('--cache',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Save the results of the external link checks in FILE
+so that they can be reused by later runs.
+The results are always reused within a run.
+ ''')
+
+    parser.add_argument('--cache-size',
+                        action='store',
+                        type=int,
+                        default=10000,
+                        metavar=('INT'),
+                        help='''The maximum number of external link check results to keep.
+The least recently used results are discarded first.
+The default is %(default)s.
+ ''')
+
+    parser.add_argument('--cache-ttl',
+                        action='store',
+                        type=int,
+                        default=86400,
+                        metavar=('SECS'),
+                        help='''The number of seconds that an external link check result
+is valid.
+The default is %(default)s.
+ ''')
+
+    parser.add_argument('--adaptive',
+                        action='store_true',
+                        help='''Slow down the requests to a host when it returns server
+errors (5xx, 429), fails to connect or its latency rises.
+A Retry-After header is honored.
+This is for fragile servers, it never makes the walk faster.
+The default is to run at full speed.
+ ''')
+
     parser.add_argument('-c', '--copy',
                         action='store',
                         type=str,
@@ -615,6 +1271,16 @@ This is used to limit what is displayed or mirrored.
 It does not affect the search algorithm.
 An example would be "-i '*.js$'" if you only wanted to see the javascript files.
 By default all results are displayed.
+ ''')
+
+    parser.add_argument('--fsync',
+                        action='store',
+                        type=int,
+                        default=0,
+                        metavar=('INT'),
+                        help='''Flush the replicated or copied files to disk in batches
+of INT files.
+The default is to let the operating system decide.
  ''')
 
     parser.add_argument('-i', '--include',
@@ -681,6 +1347,14 @@ external sites.
                         help='''The number of spaces to indent per level if -I is specified.
 If -I is not specified, this option is ignored.
 The default is %(default)s.
+ ''')
+
+    parser.add_argument('--stats',
+                        action='store_true',
+                        help='''Report the request statistics and the current request
+limit for each host at the end.
+With --adaptive the limit adapts to the latency and the errors,
+1.00 is full speed.
  ''')
 
     parser.add_argument('-u', '--username',
@@ -698,6 +1372,26 @@ is prompted for the password.
       -v  Show the content-length.
    -v -v  Show the content-length and the content-type.
 -v -v -v  Show the content-length, the content-type and the header.
+ ''')
+
+    parser.add_argument('--writers',
+                        action='store',
+                        type=int,
+                        default=4,
+                        metavar=('INT'),
+                        help='''The number of threads that write the replicated or
+copied files.
+The default is %(default)s.
+ ''')
+
+    parser.add_argument('--write-buffer',
+                        action='store',
+                        type=int,
+                        default=64,
+                        metavar=('MB'),
+                        help='''The maximum number of megabytes waiting to be written.
+The walk waits when it is reached.
+The default is %(default)s.
  ''')
 
     parser.add_argument('-V', '--version',
@@ -757,6 +1451,17 @@ is prompted for the password.
     return opts
 
 
+def finish(opts):
+    '''
+    Finish the pending writes, save the cache and report the stats.
+    '''
+    if opts.writer is not None:
+        opts.writer.close()
+    opts.cache.save()
+    if opts.stats:
+        opts.limiter.stats()
+
+
 def main():
     '''
     Main
@@ -764,12 +1469,22 @@ def main():
     opts = getopts()
     dups = {}
     url = opts.URL
+    setattr(opts, 'listing', {})  # autoindex entries by url
+    setattr(opts, 'cache', LinkCache(opts.cache, opts.cache_ttl, opts.cache_size))
+    setattr(opts, 'session', Session(opts))
+    setattr(opts, 'limiter', HostLimiter(opts.adaptive))
+    setattr(opts, 'writer', None)
+    if opts.replicate or opts.copy:
+        opts.writer = FileWriter(opts.writers, opts.write_buffer*1024*1024,
+                                 opts.fsync, opts.no_warnings)
     try:
         regex_compile(opts)
         walk(url, opts, dups)
     except KeyboardInterrupt:
         sys.stderr.write('\n^C interrupt\n')
         sys.exit(1)
+    finally:
+        finish(opts)  # keep the files and the cache even if the walk fails
 
 
 if __name__ == '__main__':